@@ -5,24 +5,236 @@ An error message example could be: Failed to pull image ...
 
 The script goes through this sequence of steps:
 - read all recent events across all namespaces
-- return a list of Pods that have the error message
-- iterate through above Pods list and
-    - check if Pod exists
-    - wait for a few seconds and check if Pod is still in a Pending state
-    - delete Pod if in Pending state
+- return a list of Pending Pods that have the error message
+- wait for a few seconds and iterate through above Pods list
+- delete Pod if still in Pending state
 
-Script executes the above steps every n seconds.
+Pods in Pending state and Pod events are kept in in-memory caches
+that are listed once and then updated from watches in background threads.
+Script executes the above steps against the caches every n seconds.
 """
 
-from kubernetes import client, config
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+import json
 import logging
 import time
 from datetime import datetime, timezone
+from dateutil.parser import isoparse
 import os
 import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 
 
+class ListWatchCache:
+
+    """
+    Keeps an in-memory copy of k8s objects across all namespaces.
+    Objects are listed once, then kept up to date from a watch
+    running in a background thread.
+    Objects are kept as parsed JSON dicts rather than client models,
+    projected by _project() to the fields readers need,
+    and are keyed by (name, namespace).
+    """
+
+    # list in chunks so each request stays well under the apiserver request timeout
+    page_size = 500
+    # client-side (connect, read) timeouts, so a half-open connection can't block
+    # the background thread forever; the watch read timeout adds a margin to the
+    # server-side watch timeout
+    list_request_timeout = (10, 60)
+    watch_timeout = 300
+    watch_request_timeout = (10, watch_timeout + 30)
+
+    def __init__(self, list_func, field_selector=None):
+        self.__list_func = list_func
+        self.__field_selector = field_selector
+        self.__items = {}
+        self.__resource_version = None
+        self.__lock = threading.RLock()
+        self.__synced = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__items
+
+    def start(self):
+        """Starts the background list/watch thread."""
+        self.__thread.start()
+
+    def wait_for_sync(self, timeout=None):
+        """
+        Waits until the initial list was loaded.
+        returns: bool
+        """
+        return self.__synced.wait(timeout)
+
+    def items(self):
+        """Returns a snapshot of cached objects."""
+        with self.__lock:
+            return list(self.__items.values())
+
+    def _project(self, obj):
+        """Returns the part of a listed or watched object kept in the cache."""
+        return obj
+
+    def __list_pages(self, **list_params):
+        """
+        Lists objects in pages of page_size items, following continue tokens.
+        An expired continue token raises ApiException 410, which restarts the list.
+        returns: generator of list results
+        """
+        while True:
+            response = self.__list_func(limit=self.page_size,
+                                        _preload_content=False,
+                                        _request_timeout=self.list_request_timeout,
+                                        **list_params)
+            try:
+                result = json.loads(response.data)
+            finally:
+                response.release_conn()
+            yield result
+            continue_token = result['metadata'].get('continue')
+            if not continue_token:
+                break
+            # continuation pages are served from the first page snapshot
+            list_params = {'field_selector': self.__field_selector, '_continue': continue_token}
+
+    def __list(self):
+        """
+        Lists objects and replaces the cache content.
+        If a resourceVersion was already observed, list from a state not older than it.
+        """
+        list_params = {'field_selector': self.__field_selector}
+        if self.__resource_version:
+            list_params['resource_version'] = self.__resource_version
+            list_params['resource_version_match'] = 'NotOlderThan'
+        items = {}
+        for result in self.__list_pages(**list_params):
+            for i in result['items']:
+                items[(i['metadata']['name'], i['metadata'].get('namespace'))] = self._project(i)
+        with self.__lock:
+            self.__items = items
+            self.__resource_version = result['metadata']['resourceVersion']
+        self.__synced.set()
+
+    def __watch(self):
+        """Applies watch events from the last observed resourceVersion to the cache."""
+        # return_type 'object' skips deserializing watched objects into models
+        w = watch.Watch(return_type='object')
+        for event in w.stream(self.__list_func,
+                              field_selector=self.__field_selector,
+                              resource_version=self.__resource_version,
+                              allow_watch_bookmarks=True,
+                              timeout_seconds=self.watch_timeout,
+                              _request_timeout=self.watch_request_timeout):
+            i = event['raw_object']
+            if event['type'] == 'BOOKMARK':
+                self.__resource_version = i['metadata']['resourceVersion']
+                continue
+            key = (i['metadata']['name'], i['metadata'].get('namespace'))
+            with self.__lock:
+                if event['type'] == 'DELETED':
+                    self.__items.pop(key, None)
+                else:
+                    self.__items[key] = self._project(i)
+                self.__resource_version = i['metadata']['resourceVersion']
+
+    def __run(self):
+        relist = True
+        while True:
+            try:
+                if relist:
+                    self.__list()
+                    relist = False
+                self.__watch()
+            except ApiException as e:
+                if e.status == 410:
+                    # resourceVersion is too old, re-list and restart the watch
+                    logging.info('Watch expired at resourceVersion %s, re-listing.', self.__resource_version)
+                    relist = True
+                else:
+                    logging.info(e)
+                    time.sleep(5)
+            except Exception as e:
+                logging.info(e)
+                time.sleep(5)
+
+
+class PodCache(ListWatchCache):
+
+    """
+    Caches Pods in Pending state across all namespaces.
+    Pods are requested as PartialObjectMetadata, since only
+    their presence in the cache is needed.
+    """
+
+    query_param_names = {
+        'allow_watch_bookmarks': 'allowWatchBookmarks',
+        '_continue': 'continue',
+        'field_selector': 'fieldSelector',
+        'limit': 'limit',
+        'resource_version': 'resourceVersion',
+        'resource_version_match': 'resourceVersionMatch',
+        'timeout_seconds': 'timeoutSeconds',
+        'watch': 'watch',
+        }
+
+    def __init__(self, core_api):
+        self.__api_client = core_api.api_client
+        super().__init__(self.list_pod_metadata_for_all_namespaces, field_selector='status.phase=Pending')
+
+    def _project(self, obj):
+        """Keeps no Pod data, cache membership means the Pod is Pending."""
+        return True
+
+    def list_pod_metadata_for_all_namespaces(self, _preload_content=True, _request_timeout=None, **kwargs):
+        """
+        Lists or watches Pod metadata across all namespaces.
+        Pods are returned with only metadata set.
+        """
+        query_params = [(self.query_param_names[k], v) for k, v in kwargs.items() if v is not None]
+        as_kind = 'PartialObjectMetadata' if kwargs.get('watch') else 'PartialObjectMetadataList'
+        return self.__api_client.call_api(
+            '/api/v1/pods', 'GET',
+            query_params=query_params,
+            header_params={'Accept': f'application/json;as={as_kind};g=meta.k8s.io;v=v1,application/json'},
+            response_type='V1PodList',
+            auth_settings=['BearerToken'],
+            _return_http_data_only=True,
+            _preload_content=_preload_content,
+            _request_timeout=_request_timeout
+            )
+
+
+class EventCache(ListWatchCache):
+
+    """Caches Pod Warning Events across all namespaces."""
+
+    def __init__(self, core_api):
+        super().__init__(core_api.list_event_for_all_namespaces, field_selector='involvedObject.kind=Pod,type=Warning')
+
+    def _project(self, obj):
+        """Keeps only the Event fields used to match errored Pods."""
+        involved_object = obj.get('involvedObject', {})
+        series = obj.get('series') or {}
+        return {
+            'message': obj.get('message'),
+            'type': obj.get('type'),
+            'reason': obj.get('reason'),
+            'lastTimestamp': obj.get('lastTimestamp'),
+            'eventTime': obj.get('eventTime'),
+            'series': {'lastObservedTime': series.get('lastObservedTime')},
+            'involvedObject': {
+                'name': involved_object.get('name'),
+                'namespace': involved_object.get('namespace'),
+                },
+            }
+
+
 class K8sClass:
 
     """
@@ -35,107 +247,83 @@ class K8sClass:
         level=logging.INFO
         )
 
-    def __init__(self, error_message):
-        self.__core_api = client.CoreV1Api()
-        self.__namespaces = []
-        self.__k8s_client_connected = False
+    # seconds a deleted or not found Pod is skipped for (default termination grace period)
+    gone_pod_ttl = 30
+
+    def __init__(self, error_message, poll_interval=None, event_age=None, api_client=None, max_workers=16):
+        # a single ApiClient (and its connection pool) is shared by the caches and Pod deletes
+        self.__core_api = client.CoreV1Api(api_client)
+        self.__pod_cache = PodCache(self.__core_api)
+        self.__event_cache = EventCache(self.__core_api)
+        self.__pod_cache.start()
+        self.__event_cache.start()
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Pods deleted or not found recently: {(pod_name, pod_namespace): expiry}
+        self.__gone_pods = {}
         self.error_message = error_message
-        # self.poll_interval = 60 if poll_interval is None else poll_interval
-        # self.event_age = event_age
+        self.poll_interval = 60 if poll_interval is None else poll_interval
+        self.event_age = event_age
 
     def __time_track(func):
         """
         Decorator used for measuring time execution of methods.
         """
         def wrapper(*arg, **kw):
-            t1 = time.time()
+            # perf_counter is monotonic and high resolution, unlike time.time()
+            t1 = time.perf_counter_ns()
             result = func(*arg, **kw)
-            total_time = time.time() - t1
-            logging.info(f'{func.__name__} ran in {total_time} seconds.')
+            total_time = (time.perf_counter_ns() - t1) / 1e9
+            logging.info('%s ran in %s seconds.', func.__name__, total_time)
             return result
         return wrapper
 
     # @__time_track 
-    def __initialise_client(self):
-        if not self.__k8s_client_connected:
-            try:
-                client.CoreV1Api
-            except Exception as e:
-                logging.info(e)
-                raise
-            else:
-                logging.info('Connection to K8s client was established.')
-                self.__k8s_client_connected = True
-                return True
+    def __delete_pod(self, pod_name, pod_namespace):
+        """Deletes Pod."""
+        try:
+            self.__core_api.delete_namespaced_pod(pod_name, pod_namespace)
+        except Exception as e:
+            if isinstance(e, ApiException) and e.status == 404:
+                self.__gone_pods[(pod_name, pod_namespace)] = time.monotonic() + self.gone_pod_ttl
+            logging.info('Pod %s in namespace %s could not be deleted: \n%s', pod_name, pod_namespace, e)
+            # raise
         else:
-            return True
+            # Pod stays Pending in the cache while terminating
+            self.__gone_pods[(pod_name, pod_namespace)] = time.monotonic() + self.gone_pod_ttl
+            logging.info('Deleted Pod %s in namespace %s', pod_name, pod_namespace)
 
     # @__time_track 
-    def __get_namespaces(self):
-        """"Returns a list of namespaces in the cluster."""
-        if self.__initialise_client():
-            try:
-                result = self.__core_api.list_namespace()
-            except Exception as e:
-                logging.info(e)
-                raise
-            else:
-                for i in result.items:
-                    self.__namespaces.append(i.metadata.name)
-            logging.debug(f'Namespaces: {self.__namespaces}')
-            return self.__namespaces
+    def __delete_pending_pod(self, pod):
+        """Deletes Pod if it still exists in Pending state."""
+        pod_name, pod_namespace = pod
+        if pod in self.__pod_cache:
+            self.__delete_pod(pod_name, pod_namespace)
         else:
-            logging.info('Connection to K8s client failed.')
+            logging.info("Pod %s in namespace %s doesn't exist anymore or is not Pending!", pod_name, pod_namespace)
 
     # @__time_track 
-    def __verify_pod_exists(self, pod_name, pod_namespace):
+    def __is_recent_pending_pod(self, event, pod, current_time):
         """
-        Verifies if Pod exists.
-        returns: bool
+        Checks if Event with error message is recent and if its Pod is in Pending state.
+        pod: (pod_name, pod_namespace) of the Event involved object
+        return: bool
         """
-        if self.__initialise_client():
-            logging.debug(f'Verifies if Pod {pod_namespace}/{pod_name} exists.')
-            try:
-                self.__core_api.read_namespaced_pod(pod_name, pod_namespace)
-            except Exception as e:
-                logging.debug(e)
+        # skip Event if last seen more than self.event_age seconds ago;
+        # events.k8s.io Events (e.g. FailedScheduling) leave lastTimestamp unset,
+        # keep eventTime as the first occurrence and record repeats in series
+        event_time = event['series']['lastObservedTime'] or event.get('lastTimestamp') or event.get('eventTime')
+        if self.event_age is not None and event_time is not None:
+            if (current_time - isoparse(event_time)).total_seconds() > self.event_age:
                 return False
-            else:
-                return True
-        else:
-            logging.info('Connection to K8s client failed.')
-
-    # @__time_track 
-    def __delete_pod(self, pod_name, pod_namespace):
-        """Deletes Pod."""
-        if self.__initialise_client():
-            try:
-                self.__core_api.delete_namespaced_pod(pod_name, pod_namespace)
-            except Exception as e:
-                logging.info(f'Pod {pod_name} in namespace {pod_namespace} could not be deleted: \n{e}')
-                # raise
-            else:
-                logging.info(f'Deleted Pod {pod_name} in namespace {pod_namespace}')
-        else:
-            logging.info('Connection to K8s client failed.')
-
-    # @__time_track 
-    def __get_pod_status(self, pod_name, pod_namespace):
-        """"Returns Pod status."""
-        if self.__initialise_client():
-            logging.debug(f'Getting {pod_namespace}/{pod_name} Pod status')
-            try:
-                result = self.__core_api.read_namespaced_pod_status(pod_name, pod_namespace)
-            except Exception as e:
-                logging.info(e)
-                # raise
-                return ""
-            else:
-                pod_status = result.status.phase
-                logging.debug(f' Pod {pod_namespace}/{pod_name} status is: {pod_status}')
-                return pod_status
-        else:
-            logging.info('Connection to K8s client failed.')
+        event_pod, event_ns = pod
+        logging.debug('%s %s %s %s \n%s', event.get('type'), event.get('reason'), event_pod, event_ns, event.get('message'))
+        if pod in self.__gone_pods:
+            logging.debug('Pod %s in namespace %s was deleted recently.', event_pod, event_ns)
+            return False
+        if pod in self.__pod_cache:
+            return True
+        logging.debug("Pod %s in namespace %s doesn't exist anymore or is not Pending!", event_pod, event_ns)
+        return False
 
     # @__time_track 
     def __get_pods_with_error_event(self):
@@ -143,66 +331,46 @@ class K8sClass:
         Returns a list of existing Pods with error message in events.
         return: {(pod_name, pod_namespace),...}
         """
-        if self.__initialise_client():
-            self.__namespaces = self.__get_namespaces()
-            errored_pods = []
-            # current_time = datetime.now(timezone.utc)
-            for namespace in self.__namespaces:
-                try:
-                    result = self.__core_api.list_namespaced_event(namespace)
-                except Exception as e:
-                    logging.info(e)
-                    raise
-                else:
-                    for i in result.items:
-                        if i.involved_object.kind == 'Pod':
-                            # calculate Event age in seconds
-                            # event_age = current_time - i.last_timestamp
-                            # if event is recent and contains Error message
-                            # if self.error_message in i.message and event_age.seconds < self.event_age:
-                            if self.error_message in i.message:
-                                event_type = i.type
-                                event_reason = i.reason
-                                event_message = i.message
-                                event_pod = i.involved_object.name
-                                event_ns = i.involved_object.namespace
-                                logging.debug(f'{event_type} {event_reason} {event_pod} {event_ns} \n{event_message}')
-                                if self.__verify_pod_exists(event_pod, event_ns):
-                                    if self.__get_pod_status(event_pod, event_ns) == 'Pending':
-                                        errored_pods.append((event_pod, event_ns))
-                                else:
-                                    logging.debug(f"Pod {event_pod} in namespace {event_ns} doesn't exist anymore!")
-            errored_pods = list(dict.fromkeys(errored_pods))
-            if len(errored_pods) > 0:
-                logging.info(f'There are {len(errored_pods)} Pods with Error Event {self.error_message} in Pending state: \n{errored_pods}')
-            else:
-                logging.info(f'There are {len(errored_pods)} Pods with Error Event {self.error_message} in Pending state.')
-            return errored_pods
+        if not (self.__pod_cache.wait_for_sync(self.poll_interval) and self.__event_cache.wait_for_sync(self.poll_interval)):
+            logging.info('Pods and Events caches are not synced yet.')
+            return []
+        errored_pods = set()
+        current_time = datetime.now(timezone.utc)
+        # forget Pods deleted more than gone_pod_ttl seconds ago
+        now = time.monotonic()
+        self.__gone_pods = {k: v for k, v in self.__gone_pods.items() if v > now}
+        error_message = self.error_message
+        for i in self.__event_cache.items():
+            # check error message first, most Events don't have it
+            message = i.get('message')
+            if not message or error_message not in message:
+                continue
+            # a failing Pod usually has many Events, check it only once
+            involved_object = i['involvedObject']
+            pod = (involved_object.get('name'), involved_object.get('namespace'))
+            if pod in errored_pods:
+                continue
+            if self.__is_recent_pending_pod(i, pod, current_time):
+                errored_pods.add(pod)
+        errored_pods = list(errored_pods)
+        if len(errored_pods) > 0:
+            logging.info('There are %s Pods with Error Event %s in Pending state: \n%s', len(errored_pods), self.error_message, errored_pods)
         else:
-            logging.info('Connection to K8s client failed.')
+            logging.info('There are %s Pods with Error Event %s in Pending state.', len(errored_pods), self.error_message)
+        return errored_pods
 
     # @__time_track 
     def delete_pending_pods(self):
         """Delete Pending Pods with error message from all namespaces."""
-        if self.__initialise_client():
-            pods_in_pending_state = self.__get_pods_with_error_event()
-            if len(pods_in_pending_state) >= 1:
-                time.sleep(5)   # wait a few seconds just in case Pod transitions state from Pending to Running
-                for pod_name, pod_namespace in pods_in_pending_state:
-                    # verify Pod exists
-                    if self.__verify_pod_exists(pod_name, pod_namespace):
-                        # delete Pod if in Pending state
-                        if self.__get_pod_status(pod_name, pod_namespace) == 'Pending':
-                            self.__delete_pod(pod_name, pod_namespace)
-                    else:
-                        logging.info(f"Pod {pod_name} in namespace {pod_namespace} doesn't exist anymore!")
-        else:
-            logging.info('Connection to K8s client failed.')
+        pods_in_pending_state = self.__get_pods_with_error_event()
+        if len(pods_in_pending_state) >= 1:
+            time.sleep(5)   # wait a few seconds just in case Pod transitions state from Pending to Running
+            list(self.__executor.map(self.__delete_pending_pod, pods_in_pending_state))
 
     # @__time_track 
     def delete_pending_pods_loop(self):
         """
-        Checks events every self.poll_interval seconds for Pending Pods.
+        Checks cached events every self.poll_interval seconds for Pending Pods.
         Delete pending pods that have error_message.
         """
 
@@ -230,6 +398,21 @@ def main():
                         default=10,
                         help="Search and delete Pods in Pending state with Error Message every n seconds.",
                         required=False)
+    parser.add_argument('--event-age',
+                        type=int,
+                        default=None,
+                        help="Only consider Events last seen in the last n seconds (series.lastObservedTime, lastTimestamp or eventTime). All cached Events are considered by default.",
+                        required=False)
+    parser.add_argument('--max-workers',
+                        type=int,
+                        default=16,
+                        help="Maximum number of Pods deleted concurrently.",
+                        required=False)
+    parser.add_argument('--connection-pool-maxsize',
+                        type=int,
+                        default=50,
+                        help="Maximum number of connections kept open to the k8s API server.",
+                        required=False)
     args = parser.parse_args()
 
     # authenticate k8s client
@@ -239,14 +422,20 @@ def main():
     else:
         config.load_kube_config()  # outside cluster authentication
 
+    # allow concurrent requests (watches, deletes) without queuing on the connection pool
+    k8s_config = client.Configuration.get_default_copy()
+    k8s_config.connection_pool_maxsize = args.connection_pool_maxsize
+    api_client = client.ApiClient(configuration=k8s_config)
+
     # delete pending pods loop
     job = K8sClass(
-        error_message=args.error_message
+        error_message=args.error_message,
+        poll_interval=args.polling_interval,
+        event_age=args.event_age,
+        api_client=api_client,
+        max_workers=args.max_workers
         )
-    while True:
-        print()
-        job.delete_pending_pods()
-        time.sleep(args.polling_interval)
+    job.delete_pending_pods_loop()
 
 
 if __name__ == '__main__':